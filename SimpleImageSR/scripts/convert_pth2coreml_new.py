@@ -4,14 +4,20 @@ PyTorch版RealESRGANの重みファイル（.pth）をCoreMLモデル（.mlpacka
 
 【特徴・設計方針】
 - 入力: RGB画像 (uint8, 0-255, 解像度可変) → CoreML側で0-1正規化
-- 出力: RGB画像 (float, 0-1, 解像度可変)
-- 入出力ともRGB順、バッチ1枚、解像度はRangeDimで可変
+- 出力: RGB画像 (uint8, 0-255, 解像度可変) → CoreMLが8bitのピクセルバッファとして返す
+- 入出力ともBGR順（--color-layout rgb でRGB順）、バッチ1枚、解像度はRangeDimで可変
+  (BGRはSwiftアプリの kCVPixelFormatType_32BGRA バッファに合わせた既定値。
+   quick_sr.py など PIL の convert("RGB") 画像を直接渡す場合は rgb を指定する。
+   ホスト側はuint8のまま渡し、float化はCoreMLで行う)
 - 出力はtorch.clampで0-1にクリップ保証
 - コマンドライン引数で各種パラメータ指定可
 - 変換失敗時は詳細エラー、成功時は保存先パスをprint
 
 【利用例】
 python convert_pth2coreml_new.py --pth weights/RealESRGAN_x4plus.pth --out output/RealESRGAN_x4plus.mlpackage --float16 --target mac --min-dim 64 --max-dim 2048
+python convert_pth2coreml_new.py --pth weights/RealESRGAN_x4plus.pth --out output/RealESRGAN_x4plus_rgb.mlpackage --float16 --color-layout rgb
+python convert_pth2coreml_new.py --pth weights/RealESRGAN_x4plus.pth --out output/RealESRGAN_x4plus_8bit.mlpackage --float16 --nbits 8
+python convert_pth2coreml_new.py --pth weights/RealESRGAN_x4plus.pth --out output/RealESRGAN_x4plus.mlpackage --float16 --fixed-size 512 512
 """
 
 import argparse
@@ -21,12 +27,14 @@ import coremltools as ct
 import numpy as np
 import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
-from coremltools.models.neural_network import quantization_utils
-
-from coremltools.models.neural_network.quantization_utils import (
-    /
+from coremltools.optimize.coreml import (
+    OpPalettizerConfig,
+    OptimizationConfig,
+    palettize_weights,
 )
 
+from model_paths import fixed_model_path
+
 
 class ClampedModel(torch.nn.Module):
     """
@@ -66,17 +74,158 @@ def load_rrdbnet(pth_path: str) -> torch.nn.Module:
     model = RRDBNet(
         num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4
     )
-    ckpt = torch.load(pth_path, map_location="cpu")
-    for key in ("params_ema", "params"):
-        if key in ckpt:
-            model.load_state_dict(ckpt[key], strict=True)
-            break
-    else:
+    # mmapで必要なテンソルだけを読み込み、ロード時のピークメモリを抑える
+    ckpt = torch.load(pth_path, map_location="cpu", mmap=True, weights_only=True)
+    state_dict = ckpt.get("params_ema")
+    if state_dict is None:
+        state_dict = ckpt.get("params")
+    if state_dict is None:
         raise RuntimeError("params_ema または params キーが見つかりません")
+    del ckpt  # 使わない方の重みを即解放
+    model.load_state_dict(state_dict, strict=True)
     model.eval()
     return model
 
 
+def export_candidates(model, example_input, dim_range=None):
+    """
+    ct.convert に渡す形状非依存のIRを、試す順に1つずつ生成する。
+    - まず torch.jit.script、次に torch.export の ExportedProgram
+    - 遅延生成のため、scriptで変換まで成功すれば torch.export は実行しない
+    - torch.jit.trace は形状を定数化し、23ブロックのRRDBでは非常に遅いため使わない
+    - dim_range=(min, max) のときH/Wを動的次元、Noneのとき example_input の形状で固定
+    """
+    try:
+        yield "torch.jit.script", torch.jit.script(model)
+    except Exception as e:
+        print(f"[WARN] torch.jit.script に失敗: {e} → torch.export で再試行")
+
+    if dim_range is None:
+        yield "torch.export", torch.export.export(model, (example_input,))
+        return
+    min_dim, max_dim = dim_range
+    dim_h = torch.export.Dim("H", min=min_dim, max=max_dim)
+    dim_w = torch.export.Dim("W", min=min_dim, max=max_dim)
+    yield "torch.export", torch.export.export(
+        model,
+        (example_input,),
+        dynamic_shapes={"x": {2: dim_h, 3: dim_w}},
+    )
+
+
+def convert_exported(candidates, conversion_options):
+    """
+    IRの候補を順に ct.convert し、最初に成功したモデルを返す。
+    - TorchScriptの変換はcoremltoolsで実験的扱いのため、失敗時は次の候補で再試行
+    """
+    error = None
+    for name, program in candidates:
+        try:
+            return ct.convert(program, **conversion_options)
+        except Exception as e:
+            print(f"[WARN] {name} のCoreML変換に失敗: {e}")
+            error = e
+    raise RuntimeError("すべてのエクスポート方式でCoreML変換に失敗しました") from error
+
+
+def convert_model(model, args, fixed_size=None):
+    """
+    ラップ済みモデルをCoreML (mlprogram) へ変換する。
+    - fixed_size=None: 解像度可変 (RangeDim) モデル
+    - fixed_size=(H, W): 入力解像度を固定し、ANEのカーネル特化を効かせるモデル
+    """
+    # 1. 入力・出力仕様を定義
+    if fixed_size:
+        height, width = fixed_size
+        shape = ct.Shape(shape=(1, 3, height, width))
+    else:
+        shape = ct.Shape(
+            shape=(
+                1,
+                3,
+                ct.RangeDim(args.min_dim, args.max_dim),  # 高さ
+                ct.RangeDim(args.min_dim, args.max_dim),  # 幅
+            )
+        )
+    # Swiftアプリは32BGRAのピクセルバッファを渡すため既定はBGR (ImageConverter.swift 参照)
+    layout = {"bgr": ct.colorlayout.BGR, "rgb": ct.colorlayout.RGB}[args.color_layout]
+    input_desc = ct.ImageType(
+        name="input_image",
+        shape=shape,
+        color_layout=layout,
+        bias=[0.0, 0.0, 0.0],
+        scale=1 / 255.0,  # uint8→float32(0-1)
+    )
+    # mlprogram形式では出力ImageTypeのscale指定は無効なため、×255はClampedModel内で行う。
+    # RGBのImageType出力は8bitのピクセルバッファとして返るので、
+    # float32/float16のMultiArrayで返すよりホストへの転送量が小さい
+    output_desc = ct.ImageType(
+        name="output_image",
+        color_layout=layout,
+    )
+
+    # 2. 変換オプション
+    precision = ct.precision.FLOAT16 if args.float16 else ct.precision.FLOAT32
+    target_map = {"mac": ct.target.macOS14, "ios": ct.target.iOS17}
+    conversion_options = {
+        "source": "pytorch",
+        "inputs": [input_desc],
+        "outputs": [output_desc],
+        "convert_to": "mlprogram",
+        "minimum_deployment_target": target_map[args.target],
+        "compute_precision": precision,
+        # 全Conv構成のRRDBをANEに固定し、ANE↔GPU間の転送を避ける
+        "compute_units": ct.ComputeUnit.CPU_AND_NE,
+    }
+
+    # 3. IRへエクスポート (script → export の順に、変換まで成功するものを採用)
+    if fixed_size:
+        example_input = torch.rand(1, 3, height, width, dtype=torch.float32)
+        candidates = export_candidates(model, example_input)
+    else:
+        example_input = torch.rand(
+            1, 3, args.trace_size, args.trace_size, dtype=torch.float32
+        )
+        candidates = export_candidates(
+            model, example_input, (args.min_dim, args.max_dim)
+        )
+
+    # 4. CoreML変換
+    order = args.color_layout.upper()
+    print(f"[INFO] 入力: {order}, uint8, 0-255 → CoreMLで0-1正規化 (scale=1/255.0)")
+    print(f"[INFO] 出力: {order}, uint8, 0-255 (ImageType で即 PNG/JPEG 保存可能)")
+    if fixed_size:
+        print(f"[INFO] 入力shape: (1,3,{height},{width}) 固定解像度")
+    else:
+        print(
+            "[INFO] 入力shape: (1,3,H,W) 可変範囲: {}-{}px".format(
+                args.min_dim, args.max_dim
+            )
+        )
+
+    mlmodel = convert_exported(candidates, conversion_options)
+    print(f"DEBUG: Type of mlmodel after conversion: {type(mlmodel)}")
+    print(f"DEBUG: Value of mlmodel after conversion: {mlmodel}")
+
+    # FP16化は compute_precision のみで行う。
+    # quantize_weights による二重量子化は mlprogram の重みを再生成し、
+    # 変換時間の倍増や精度劣化の原因となるため行わない。
+    if args.float16:
+        print("[INFO] FP16精度で変換 (compute_precision=FLOAT16)")
+    else:
+        print("[WARN] FP32ではANEで実行されない演算が増えます。--float16 を推奨")
+
+    # 4.1 重みのパレット化 (nbits<16 のとき)
+    if args.nbits < 16:
+        print(f"[INFO] 重みを{args.nbits}bitにパレット化 (kmeans)")
+        config = OptimizationConfig(
+            global_config=OpPalettizerConfig(mode="kmeans", nbits=args.nbits)
+        )
+        mlmodel = palettize_weights(mlmodel, config)
+
+    return mlmodel
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="PyTorch RealESRGAN (.pth) → CoreML 変換ツール"
@@ -92,6 +241,12 @@ def main():
         default="mac",
         help="デプロイターゲット(mac/ios)",
     )
+    parser.add_argument(
+        "--color-layout",
+        choices=["bgr", "rgb"],
+        default="bgr",
+        help="入出力画像のチャンネル順。Swiftアプリ用はbgr、quick_sr.py用はrgb (default: bgr)",
+    )
     parser.add_argument(
         "--min-dim", type=int, default=64, help="最小解像度 (default: 64)"
     )
@@ -102,7 +257,21 @@ def main():
         "--trace-size",
         type=int,
         default=64,
-        help="トレース用ダミー画像サイズ (default: 64)",
+        help="エクスポート用ダミー画像サイズ (default: 64)",
+    )
+    parser.add_argument(
+        "--nbits",
+        type=int,
+        choices=[4, 6, 8, 16],
+        default=16,
+        help="重みのビット数。16未満ならk-meansでパレット化 (default: 16)",
+    )
+    parser.add_argument(
+        "--fixed-size",
+        type=int,
+        nargs=2,
+        metavar=("H", "W"),
+        help="指定時、入力解像度をH×Wに固定したモデルも <out>_<H>x<W> として保存",
     )
     args = parser.parse_args()
 
@@ -111,68 +280,19 @@ def main():
         model = load_rrdbnet(args.pth)
         model = ClampedModel(model)  # 出力を0-1にclampするラッパー
 
-        # 2. 入力・出力仕様を定義
-        input_desc = ct.ImageType(
-            name="input_image",
-            shape=ct.Shape(
-                shape=(
-                    1,
-                    3,
-                    ct.RangeDim(args.min_dim, args.max_dim),  # 高さ
-                    ct.RangeDim(args.min_dim, args.max_dim),  # 幅
-                )
-            ),
-            color_layout=ct.colorlayout.BGR,
-            bias=[0.0, 0.0, 0.0],
-            scale=1 / 255.0,  # uint8→float32(0-1)
-        )
-        # mlprogram形式では出力ImageTypeのscale指定は無効。float32(0-1)出力となる
-        output_desc = ct.ImageType(
-            name="output_image",
-            color_layout=ct.colorlayout.BGR,
-        )
-
-        # 3. 変換オプション
-        precision = ct.precision.FLOAT16 if args.float16 else ct.precision.FLOAT32
-        target_map = {"mac": ct.target.macOS14, "ios": ct.target.iOS17}
-        conversion_options = {
-            "source": "pytorch",
-            "inputs": [input_desc],
-            "outputs": [output_desc],
-            "convert_to": "mlprogram",
-            "minimum_deployment_target": target_map[args.target],
-            "compute_precision": precision,
-            "compute_units": ct.ComputeUnit.ALL,
-        }
-
-        # 4. トレース用ダミー入力
-        example_input = torch.rand(
-            1, 3, args.trace_size, args.trace_size, dtype=torch.float32
-        )
-        traced = torch.jit.trace(model, example_input)
-
-        # 5. CoreML変換
-        print("[INFO] 入力: RGB, uint8, 0-255 → CoreMLで0-1正規化 (scale=1/255.0)")
-        print("[INFO] 出力: RGB, float32, 0-255 (ImageType で即 PNG/JPEG 保存可能)")
-        print(
-            "[INFO] 入力shape: (1,3,H,W) 可変範囲: {}-{}px".format(
-                args.min_dim, args.max_dim
-            )
-        )
-
-        mlmodel = ct.convert(traced, **conversion_options)
-        print(f"DEBUG: Type of mlmodel after conversion: {type(mlmodel)}")
-        print(f"DEBUG: Value of mlmodel after conversion: {mlmodel}")
-
-        # 5.1 量子化オプション
-        if args.float16:
-            print("[INFO] FP16精度で変換")
-            mlmodel = quantization_utils.quantize_weights(mlmodel, nbits=16)
-    
-        # 6. CoreMLモデルの保存
+        # 2. 解像度可変モデルへ変換・保存
+        mlmodel = convert_model(model, args)
         print(f"Saving CoreML model to {args.out}")
         mlmodel.save(args.out)
 
+        # 3. 固定解像度に特化したモデルを並べて保存 (--fixed-size 指定時)
+        if args.fixed_size:
+            height, width = args.fixed_size
+            fixed_out = fixed_model_path(args.out, height, width)
+            mlmodel = convert_model(model, args, fixed_size=(height, width))
+            print(f"Saving fixed-size CoreML model to {fixed_out}")
+            mlmodel.save(fixed_out)
+
         print("Conversion complete.")
     except Exception as e:
         print(f"❌ 変換エラー: {e}", file=sys.stderr)
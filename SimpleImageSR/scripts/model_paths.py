@@ -0,0 +1,11 @@
+"""
+convert_pth2coreml_new.py と quick_sr.py で共有するモデルファイル名の規則。
+"""
+
+import os
+
+
+def fixed_model_path(model_path: str, height: int, width: int) -> str:
+    """固定解像度モデルのパス (<stem>_<H>x<W><ext>) を返す"""
+    stem, ext = os.path.splitext(model_path.rstrip("/"))
+    return f"{stem}_{height}x{width}{ext}"
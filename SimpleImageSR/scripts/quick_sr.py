@@ -1,65 +1,223 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import shutil
 import time  # 時間計測用にtimeモジュールを追加
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import coremltools as ct
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
+from model_paths import fixed_model_path
+
 
 def load_image(path):
-    """画像ファイルをRGB PIL.Imageとして読み込む"""
-    img = Image.open(path).convert("RGB")
+    """
+    画像ファイルをRGB PIL.Imageとして読み込む
+    - uint8のまま渡し、0-1正規化はCoreML側(scale=1/255.0)で行う
+    - モデルは convert_pth2coreml_new.py --color-layout rgb で変換したものを使う
+      (既定のbgrはSwiftアプリのBGRAバッファ用で、PIL画像を渡すとR/Bが反転する)
+    - 既にRGBの画像ではconvertによるコピーを省く
+    - Image.openは遅延デコードのため、ここでload()して呼び出し側のスレッドでデコードを済ませる
+    """
+    img = Image.open(path)
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    img.load()
     return img
 
 
+def to_uint8(img):
+    """
+    モデル出力の配列をuint8へ変換する。
+    - 出力はClampedModelで既に0-255レンジのため、255倍は行わずクリップのみ
+    - out=引数で一時バッファを1つに抑え、大きな画像でのメモリ確保を減らす
+    """
+    if img.dtype == np.uint8:
+        return img
+    tmp = np.empty(img.shape, np.float32)
+    np.rint(img, out=tmp)
+    np.clip(tmp, 0, 255, out=tmp)
+    u8 = np.empty(img.shape, np.uint8)
+    np.copyto(u8, tmp, casting="unsafe")
+    return u8
+
+
 def save_image(arr, path):
     """
     モデル出力を画像として保存する。
     - Image.Image型のみをサポート
-    - 値域がfloatなら255倍してuint8へ変換し保存
+    - 値域0-255のfloatをuint8へ変換し保存
     """
     if isinstance(arr, Image.Image):
-        img = np.array(arr)
-        if img.max() <= 1.0:
-            img = (img * 255.0).clip(0, 255).astype(np.uint8)
-        else:
-            img = np.clip(img, 0, 255).astype(np.uint8)
-        Image.fromarray(img).save(path)
+        Image.fromarray(to_uint8(np.asarray(arr))).save(path)
     else:
         raise TypeError(
             f"サポート対象外の型です: {type(arr)}。Image.Imageインスタンスが必要です。"
         )
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument("model", help=".mlpackage or .mlmodel")
-    p.add_argument("input", help="入力画像ファイル (jpg/png)")
-    p.add_argument("output", help="出力画像ファイル (png)")
-    p.add_argument(
-        "--hist-dir", default="output", help="ヒストグラム画像の保存ディレクトリ"
-    )
-    args = p.parse_args()
+def save_histogram(counts, edges, path, title, xlabel):
+    """
+    np.histogramで集計済みのヒストグラムを棒グラフとして保存する。
+    - pyplotの自動ビニングを経由しないため大きな画像でも高速
+    - matplotlibは起動時間が大きいため、ヒストグラム保存時にのみimportする
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Count")
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def _pick_output(result):
+    """推論結果の辞書から出力を取り出す（output_image以外のキー名にも対応）"""
+    if "output_image" in result:
+        return result["output_image"]
+    return result[next(iter(result.keys()))]
+
+
+def _axis_patches(size, tile, overlap):
+    """
+    1軸方向のタイル分割を計算する。
+    - 戻り値: (start, end, seam) のリスト（LR画素単位）
+    - seam は直前のパッチとの重なり幅（先頭パッチでは0）
+    """
+    n = max(1, -(-size // tile))
+    step = -(-size // n)  # 末尾に極小タイルができないよう均等割り
+    spans = [
+        (max(x0 - overlap, 0), min(x0 + step + overlap, size))
+        for x0 in range(0, size, step)
+    ]
+    return [
+        (lo, hi, spans[i - 1][1] - lo if i > 0 else 0)
+        for i, (lo, hi) in enumerate(spans)
+    ]
+
+
+def _ramp(length):
+    """継ぎ目で新しいパッチを0→1へ線形に立ち上げる重み"""
+    return (np.arange(length, dtype=np.float32) + 0.5) / length
+
+
+def _blend(dst, src, alpha):
+    """uint8のdstへsrcをalphaで重ねる（継ぎ目の帯だけをfloatで計算する）"""
+    mixed = dst * (1.0 - alpha) + src * alpha
+    np.copyto(dst, np.rint(mixed), casting="unsafe")
+
+
+def tiled_predict(mlmodel, pil_img, tile=512, overlap=32, scale=4):
+    """
+    入力画像を重なり付きタイルに分割して推論し、継ぎ目を線形フェザーで合成する。
+    - 1回のpredictあたりのメモリ使用量を入力サイズに依存せず一定に抑える
+    - 出力はuint8のキャンバスへ直接貼り付け、floatで扱うのは継ぎ目の帯のみ
+    - モデルの最大解像度(--max-dim)を超える画像も処理可能
+    - 戻り値: uint8 RGB の Image.Image
+    """
+    w, h = pil_img.size
+    canvas = np.empty((h * scale, w * scale, 3), np.uint8)
 
-    # モデル読み込み
+    for y0, y1, seam_y in _axis_patches(h, tile, overlap):
+        sy = seam_y * scale
+        for x0, x1, seam_x in _axis_patches(w, tile, overlap):
+            sx = seam_x * scale
+            patch = pil_img.crop((x0, y0, x1, y1))
+            out = _pick_output(mlmodel.predict({"input_image": patch}))
+            out = to_uint8(np.asarray(out)[..., :3])
+            region = canvas[y0 * scale : y1 * scale, x0 * scale : x1 * scale]
+
+            # 既に書き込まれた上・左のパッチと重ならない部分はそのまま貼り付け
+            region[sy:, sx:] = out[sy:, sx:]
+
+            # 継ぎ目の帯はキャンバス上の既存の画素に対してフェザーで重ねる
+            ax = np.ones(region.shape[1], np.float32)
+            if sx:
+                ax[:sx] = _ramp(sx)
+            if sy:
+                alpha = (_ramp(sy)[:, None] * ax[None, :])[..., None]
+                _blend(region[:sy], out[:sy], alpha)
+            if sx:
+                _blend(region[sy:, :sx], out[sy:, :sx], ax[:sx][None, :, None])
+
+    return Image.fromarray(canvas)
+
+
+def load_fast(path):
+    """
+    コンパイル済みモデル(.mlmodelc)を優先して読み込む。
+    - .mlpackage/.mlmodel と同じ場所に .mlmodelc をキャッシュし、
+      次回以降の起動時の再コンパイルを省く
+    - キャッシュが元モデルより古い場合は作り直す
+    """
+    compute_units = ct.ComputeUnit.CPU_AND_NE
+    path = path.rstrip("/")
+    if path.endswith(".mlmodelc"):
+        return ct.models.CompiledMLModel(path, compute_units)
+
+    compiled = os.path.splitext(path)[0] + ".mlmodelc"
+    if not os.path.isdir(compiled) or os.path.getmtime(compiled) < os.path.getmtime(
+        path
+    ):
+        mlmodel = ct.models.MLModel(path, compute_units=compute_units)
+        shutil.rmtree(compiled, ignore_errors=True)
+        # 一時ディレクトリのコンパイル結果はmlmodel破棄時に消えるため、その前にコピー
+        shutil.copytree(mlmodel.get_compiled_model_path(), compiled)
+        print(f"コンパイル済みモデルをキャッシュしました: {compiled}")
+    return ct.models.CompiledMLModel(compiled, compute_units)
+
+
+def load_model(path, warmup_size=(64, 64)):
+    """
+    CoreMLモデルを読み込み、ウォームアップ推論を1回行って返す。
+    - 初回predictのコンパイル・ANEロードのコストを計測対象から外す
+    - warmup_size: ウォームアップ用ダミー画像の (W, H)。固定解像度モデルではその解像度
+    """
+    mlmodel = load_fast(path)
     try:
-        mlmodel = ct.models.MLModel(args.model)
+        mlmodel.predict({"input_image": Image.new("RGB", warmup_size)})
     except Exception as e:
-        print(f"❌ モデルの読み込みに失敗しました: {e}")
-        return
+        print(f"⚠️ ウォームアップ推論に失敗しました（続行します）: {e}")
+    return mlmodel
 
+
+def run(
+    mlmodel,
+    in_path,
+    out_path,
+    hist_dir="output",
+    tile=512,
+    tile_overlap=32,
+    scale=4,
+    debug=False,
+    hist=False,
+):
+    """
+    読み込み済みモデルで1枚の画像を推論し、結果を保存する。
+    - hist=True のときのみヒストグラムを保存
+    """
     # 画像読み込み
-    inp = load_image(args.input)
+    inp = load_image(in_path)
 
     # 推論
     try:
         # 推論の直前で時間計測開始
         start_time = time.time()
 
-        result = mlmodel.predict({"input_image": inp})
+        if tile > 0 and max(inp.size) > tile:
+            # 大きな画像はタイル分割して推論
+            result = {
+                "output_image": tiled_predict(
+                    mlmodel, inp, tile, tile_overlap, scale
+                )
+            }
+        else:
+            result = mlmodel.predict({"input_image": inp})
 
         # 推論の直後で時間計測終了
         end_time = time.time()
@@ -77,7 +235,8 @@ def main():
     else:
         # 最初のキーを自動取得
         out_key = next(iter(result.keys()))
-        print(f"DEBUG: Output key found: {out_key}")
+        if debug:
+            print(f"DEBUG: Output key found: {out_key}")
         out = result[out_key]
 
     # 出力が Image.Image インスタンスであることを確認
@@ -86,18 +245,18 @@ def main():
             f"モデル出力の型が Image ではありません: {type(out)} が返されました。CoreMLモデルが ImageType で出力するように設定されているか確認してください。"
         )
 
-    print(
-        f"DEBUG: Type of 'out' (model prediction result for key '{out_key}'): {type(out)}"
-    )
-    if isinstance(out, Image.Image):
+    # 出力配列は1度だけ取得して使い回す（np.asarrayで可能な限りコピーを避ける）
+    out_np = np.asarray(out)
+    if debug:
+        print(
+            f"DEBUG: Type of 'out' (model prediction result for key '{out_key}'): {type(out)}"
+        )
         print(f"DEBUG: Pillow Image mode: {out.mode}")
-        _debug_img_np = np.array(out)
         print(
-            f"DEBUG: np.array(out) -> dtype: {_debug_img_np.dtype}, shape: {_debug_img_np.shape}, min: {_debug_img_np.min():.4f}, max: {_debug_img_np.max():.4f}, mean: {_debug_img_np.mean():.4f}"
+            f"DEBUG: np.asarray(out) -> dtype: {out_np.dtype}, shape: {out_np.shape}, min: {out_np.min():.4f}, max: {out_np.max():.4f}, mean: {out_np.mean():.4f}"
         )
 
     # 出力値の情報を表示
-    out_np = np.array(out)
     print(
         "出力値 min:",
         out_np.min(),
@@ -109,56 +268,263 @@ def main():
         out_np.shape,
     )
 
-    # --- 追加: float値のままの分布を保存 ---
+    # ヒストグラム保存用ディレクトリの自動生成
+    if hist or debug:
+        os.makedirs(hist_dir, exist_ok=True)
+
+    # --- 追加: float値のままの出力を保存 ---
     if np.issubdtype(out_np.dtype, np.floating):
-        np.save(os.path.join(args.hist_dir, "output_float.npy"), out_np)
-        print(f"float値のまま保存: {os.path.join(args.hist_dir, 'output_float.npy')}")
-        print(
-            "float値 min:", out_np.min(), "max:", out_np.max(), "mean:", out_np.mean()
-        )
-        plt.figure()
-        plt.hist(out_np.flatten(), bins=100, range=(0, 1))
-        plt.title("Output Float Value Histogram (0-1)")
-        plt.xlabel("Value")
-        plt.ylabel("Count")
-        plt.savefig(os.path.join(args.hist_dir, "hist_output_float.png"))
-        print(
-            f"✅ float値ヒストグラムを保存しました: {os.path.join(args.hist_dir, 'hist_output_float.png')}"
-        )
+        if debug:
+            np.save(os.path.join(hist_dir, "output_float.npy"), out_np)
+            print(f"float値のまま保存: {os.path.join(hist_dir, 'output_float.npy')}")
+            print(
+                "float値 min:",
+                out_np.min(),
+                "max:",
+                out_np.max(),
+                "mean:",
+                out_np.mean(),
+            )
 
     # 保存
     # --- 修正: Imageインスタンスのみ処理 ---
     # outはすでにImage.Imageインスタンスであることが確認済み
-    img = np.array(out)
-    if img.max() <= 1.0:
-        img = (img * 255.0).clip(0, 255).astype(np.uint8)
-    else:
-        img = np.clip(img, 0, 255).astype(np.uint8)
-    Image.fromarray(img).save(args.output)
-    print(f"✅ 出力を保存しました: {args.output}")
+    Image.fromarray(to_uint8(out_np)).save(out_path)
+    print(f"✅ 出力を保存しました: {out_path}")
 
-    # ヒストグラム保存用ディレクトリの自動生成
-    os.makedirs(args.hist_dir, exist_ok=True)
-    hist_path = os.path.join(args.hist_dir, "hist_output.png")
+    if not hist:
+        return
 
     # ヒストグラムを保存
-    plt.figure()
-    # 値域0-255, floatの場合でも255倍されている想定
-    flat = out_np.flatten()
-    if np.issubdtype(flat.dtype, np.floating):
-        # float型なら0-1, 0-255, それ以外も考慮
-        if flat.max() <= 1.0:
-            plt.hist(flat * 255.0, bins=256, range=(0, 255))
-        else:
-            plt.hist(flat, bins=256, range=(0, 255))
-    else:
-        plt.hist(flat, bins=256, range=(0, 255))
-    plt.title("Output Image Histogram")
-    plt.xlabel("Pixel Value")
-    plt.ylabel("Count")
-    plt.savefig(hist_path)
+    # 出力はClampedModelで0-255レンジのため、floatでも0-1への換算はしない
+    counts, edges = np.histogram(out_np.ravel(), bins=256, range=(0, 255))
+    hist_path = os.path.join(hist_dir, "hist_output.png")
+    save_histogram(counts, edges, hist_path, "Output Image Histogram", "Pixel Value")
     print(f"✅ ヒストグラムを保存しました: {hist_path}")
 
+    # --- 追加: float値のままの分布を保存 ---
+    if np.issubdtype(out_np.dtype, np.floating):
+        float_hist_path = os.path.join(hist_dir, "hist_output_float.png")
+        counts, edges = np.histogram(out_np.ravel(), bins=100, range=(0, 255))
+        save_histogram(
+            counts,
+            edges,
+            float_hist_path,
+            "Output Float Value Histogram (0-255)",
+            "Value",
+        )
+        print(f"✅ float値ヒストグラムを保存しました: {float_hist_path}")
+
+
+def predict_many(mlmodel, pairs, **kwargs):
+    """
+    読み込み済みモデルを使い回して複数画像を推論する。
+    - pairs: (入力パス, 出力パス) のイテラブル
+    - kwargs は run() にそのまま渡す
+    """
+    for in_path, out_path in pairs:
+        run(mlmodel, in_path, out_path, **kwargs)
+
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+def predict_batch(mlmodel, images):
+    """
+    同じ解像度のPIL画像群をまとめて推論する。
+    - coremltoolsのバッチ予測(入力辞書のリスト)でディスパッチのオーバーヘッドを償却
+      (各辞書はN=1の入力として渡されるため、モデルはバッチ1のままでよい)
+    - 戻り値: 各画像の出力のリスト
+    """
+    results = mlmodel.predict([{"input_image": img} for img in images])
+    return [_pick_output(r) for r in results]
+
+
+def group_by_size(paths):
+    """画像パスを解像度(W,H)ごとにまとめる（ヘッダのみ読み、全体はデコードしない）"""
+    groups = {}
+    for path in paths:
+        with Image.open(path) as img:
+            groups.setdefault(img.size, []).append(path)
+    return groups
+
+
+def predict_dir(
+    mlmodel,
+    in_dir,
+    out_dir,
+    batch_size=1,
+    tile=512,
+    tile_overlap=32,
+    scale=4,
+    workers=4,
+):
+    """
+    ディレクトリ内の画像を一括推論し、out_dir に <元ファイル名>.png で保存する。
+    - 同じ解像度の画像を batch_size 枚ずつまとめて predict_batch で推論
+    - tile を超える大きな画像は1枚ずつタイル分割して推論
+    - デコード → 推論 → PNGエンコードをパイプライン化し、I/Oと推論を重ねる
+      (推論はANEを取り合わないようメインスレッドで直列実行)
+    - 先読みデコードと保存待ちの枚数は上限付きで、メモリ使用量を抑える
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = sorted(
+        os.path.join(in_dir, name)
+        for name in os.listdir(in_dir)
+        if name.lower().endswith(IMAGE_EXTS)
+    )
+
+    def out_path_for(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(out_dir, stem + ".png")
+
+    # 推論単位(ジョブ)の一覧: (解像度, パスのリスト, タイル分割するか)
+    jobs = []
+    for size, group in group_by_size(paths).items():
+        if tile > 0 and max(size) > tile:
+            jobs.extend((size, [path], True) for path in group)
+        else:
+            jobs.extend(
+                (size, group[i : i + batch_size], False)
+                for i in range(0, len(group), batch_size)
+            )
+
+    # 先読みするデコード枚数と保存待ちの枚数の上限。メモリ上の画像枚数を抑える
+    max_decoding = max(workers, batch_size)
+    max_pending_saves = workers
+
+    with ThreadPoolExecutor(max_workers=workers) as decode_pool, ThreadPoolExecutor(
+        max_workers=workers
+    ) as encode_pool:
+        job_iter = iter(jobs)
+        decoding = deque()  # (ジョブ, デコード中のFuture群)
+        saves = deque()
+
+        def prefetch():
+            # ジョブをまたいでデコードを先行投入し、デコードスレッドを遊ばせない
+            while not decoding or sum(len(j[1]) for j, _ in decoding) < max_decoding:
+                job = next(job_iter, None)
+                if job is None:
+                    return
+                futures = [decode_pool.submit(load_image, path) for path in job[1]]
+                decoding.append((job, futures))
+
+        prefetch()
+        while decoding:
+            (size, chunk, tiled), futures = decoding.popleft()
+            images = [future.result() for future in futures]
+            prefetch()
+
+            start_time = time.time()
+            if tiled:
+                outputs = [
+                    tiled_predict(mlmodel, images[0], tile, tile_overlap, scale)
+                ]
+            else:
+                outputs = predict_batch(mlmodel, images)
+            inference_time = (time.time() - start_time) * 1000
+            print(
+                f"推論時間: {inference_time:.2f} ms ({len(chunk)}枚, {size[0]}x{size[1]})"
+            )
+            for path, out in zip(chunk, outputs):
+                saves.append(encode_pool.submit(save_image, out, out_path_for(path)))
+                # 保存が推論に追いつかない場合は古いものの完了を待ってHR画像の滞留を防ぐ
+                while len(saves) > max_pending_saves:
+                    saves.popleft().result()
+        for future in saves:
+            future.result()  # 保存時の例外をここで送出
+    print(f"✅ {len(paths)}枚の出力を保存しました: {out_dir}")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("model", help=".mlpackage, .mlmodel or .mlmodelc")
+    p.add_argument("input", help="入力画像ファイル (jpg/png) またはディレクトリ")
+    p.add_argument("output", help="出力画像ファイル (png) またはディレクトリ")
+    p.add_argument(
+        "--hist", action="store_true", help="出力のヒストグラム画像を保存する"
+    )
+    p.add_argument(
+        "--hist-dir", default="output", help="ヒストグラム画像の保存ディレクトリ"
+    )
+    p.add_argument(
+        "--tile",
+        type=int,
+        default=512,
+        help="タイル分割推論のタイルサイズ (0で分割なし, default: 512)",
+    )
+    p.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=32,
+        help="タイル間の重なり幅 (default: 32)",
+    )
+    p.add_argument("--scale", type=int, default=4, help="拡大倍率 (default: 4)")
+    p.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="ディレクトリ入力時に同じ解像度の画像をまとめて推論する枚数 (default: 1)",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="ディレクトリ入力時のデコード/エンコード用スレッド数 (default: 4)",
+    )
+    p.add_argument(
+        "--debug",
+        action="store_true",
+        help="デバッグ情報の表示とfloat出力(output_float.npy)の保存を行う",
+    )
+    args = p.parse_args()
+
+    # 入力解像度に特化したモデルが並べて保存されていればそちらを使う
+    model_path = args.model
+    tile = args.tile
+    warmup_size = (64, 64)
+    if os.path.isfile(args.input):
+        with Image.open(args.input) as img:
+            width, height = img.size
+        fixed = fixed_model_path(args.model, height, width)
+        if os.path.exists(fixed):
+            print(f"固定解像度モデルを使用します: {fixed}")
+            model_path = fixed
+            tile = 0  # 固定解像度モデルには分割せずそのまま入力する
+            warmup_size = (width, height)
+
+    # モデル読み込み（ウォームアップ込み）
+    try:
+        mlmodel = load_model(model_path, warmup_size)
+    except Exception as e:
+        print(f"❌ モデルの読み込みに失敗しました: {e}")
+        return
+
+    if os.path.isdir(args.input):
+        predict_dir(
+            mlmodel,
+            args.input,
+            args.output,
+            batch_size=args.batch_size,
+            tile=args.tile,
+            tile_overlap=args.tile_overlap,
+            scale=args.scale,
+            workers=args.workers,
+        )
+        return
+
+    run(
+        mlmodel,
+        args.input,
+        args.output,
+        hist_dir=args.hist_dir,
+        tile=tile,
+        tile_overlap=args.tile_overlap,
+        scale=args.scale,
+        debug=args.debug,
+        hist=args.hist,
+    )
+
 
 if __name__ == "__main__":
     main()